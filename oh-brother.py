@@ -14,17 +14,20 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
-from pysnmp.entity.rfc3413.oneliner import cmdgen
 import urllib.request, urllib.error, urllib.parse
 import xml.etree.ElementTree as ET
-import xml.dom.minidom as minidom
 import argparse
 import sys
+import time
+import os
+import copy
 import socket
+import shutil
+import json
+import mmap
+import threading
 from ftplib import FTP
-import ssl
-import getpass
-from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
 
 
 # Yes indeed, "SELIALNO"
@@ -56,6 +59,12 @@ reqInfo = '''
   </FIRMUPDATEINFO>
 </REQUESTINFO>
 '''
+reqTemplate = ET.fromstring(reqInfo)
+
+# Drop the indentation, it is only there to make the template readable
+for e in reqTemplate.iter():
+  if e.text is not None and not e.text.strip(): e.text = None
+  e.tail = None
 
 # Parse args
 usage = '%(prog)s [OPTIONS] <printer IP address>'
@@ -80,26 +89,58 @@ parser.add_argument('-t', '--test', action = 'store_true',
 parser.add_argument('-p', '--password',
                     help = 'Upload firmware via FTP using printer admin password '
                     '(default is passwordless upload via TCP port 9100)')
+parser.add_argument('-y', '--yes', action = 'store_true',
+                    help = 'Run unattended: don\'t ask for confirmation and '
+                    'wait --reboot-wait seconds after each upload instead of '
+                    'waiting for Enter')
+parser.add_argument('-w', '--reboot-wait', type = int, default = 300,
+                    metavar = 'SECONDS',
+                    help = 'Time to allow the printer to finish updating and '
+                    'reboot when using --yes (default: %(default)s)')
 
 args = parser.parse_args()
 
+if args.reboot_wait < 0: parser.error('--reboot-wait must not be negative')
+
+
+# Wait for Enter, stop cleanly if stdin is closed or not interactive
+def prompt(msg):
+  try: input(msg)
+  except EOFError:
+    print()
+    sys.exit('No input available, use --yes to run unattended')
+
+
 # Provide information about requirements
 print('You may need to check the following in the printer\'s configuration:')
 print('  - SNMP service is enabled (for fetching model and versions)')
 if args.password:
   print('  - FTP service is enabled (for uploading firmware)')
   print('  - an administrator password is set (for connecting to FTP)')
-input('Press Ctrl-C to exit or Enter to continue...')
+if not args.yes: prompt('Press Ctrl-C to exit or Enter to continue...')
+
+# Resolve the printer address once for SNMP and the firmware upload
+ip = socket.gethostbyname(args.ip)
 
 # Get SNMP data
 print('Getting SNMP data from printer at %s...' % args.ip)
 sys.stdout.flush()
 
+# pysnmp is slow to import, so --help and argument errors don't load it
+from pysnmp.entity.rfc3413.oneliner import cmdgen
+
+snmpOID = '1.3.6.1.4.1.2435.2.4.3.99.3.1.6.1.2'
+
 cg = cmdgen.CommandGenerator()
-error, status, index, table = cg.nextCmd(
-  cmdgen.CommunityData(args.community),
-  cmdgen.UdpTransportTarget((args.ip, 161)),
-  '1.3.6.1.4.1.2435.2.4.3.99.3.1.6.1.2')
+community = cmdgen.CommunityData(args.community, mpModel = 1) # SNMPv2c
+target = cmdgen.UdpTransportTarget((ip, 161))
+
+# Fetch the whole subtree in one or two round trips with GETBULK
+error, status, index, table = cg.bulkCmd(community, target, 0, 25, snmpOID)
+
+# Fall back to a GETNEXT walk if the agent cannot fit the bulk response
+if not error and status and status.prettyPrint() == 'tooBig':
+  error, status, index, table = cg.nextCmd(community, target, snmpOID)
 
 print('done')
 
@@ -109,28 +150,27 @@ if status:
     status.prettyPrint(), index and table[-1][int(index) - 1] or '?'))
 
 # Process SNMP data
-serial   = None
-model    = None
-spec     = None
-firmId   = None
+info     = {}
 firmInfo = []
 
 if args.verbose: print(table)
 
 for row in table:
   for name, value in row:
-    value = str(value)
+    name, sep, value = str(value).partition('=')
+    if not sep: continue
+    value = value.strip(' "\r\n')
+
+    # Each FIRMVER belongs to the most recent FIRMID
+    if name == 'FIRMVER':
+      if info.get('FIRMID') and value:
+        firmInfo.append({'cat': info['FIRMID'], 'version': value})
 
-    if value.find('=') != -1:
-      name, value = value.split('=')
-      value = value.strip(' "\r\n')
+    else: info[name] = value
 
-      if name == 'MODEL':  model  = value
-      if name == 'SERIAL': serial = value
-      if name == 'SPEC':   spec   = value
-      if name == 'FIRMID': firmId = value
-      if name == 'FIRMVER' and firmId and value:
-        firmInfo.append({'cat': firmId, 'version': value})
+serial = info.get('SERIAL')
+model  = info.get('MODEL')
+spec   = info.get('SPEC')
 
 # Override model
 if args.model: model = args.model
@@ -152,26 +192,26 @@ for entry in firmInfo:
 print()
 
 
-# We need SSLv3
-def sslwrap(func):
-  @wraps(func)
-  def bar(*args, **kw):
-    kw['ssl_version'] = ssl.PROTOCOL_TLS_CLIENT
-    return func(*args, **kw)
+# Prints a dot for each block written to the wrapped file
+# Set on Ctrl-C so downloads running in worker threads stop at the next block
+stopping = threading.Event()
 
-  return bar
 
-context = ssl.create_default_context()
-ssl.wrap_socket = sslwrap(context.wrap_socket)
+class ProgressWriter:
+  def __init__(self, f): self.f = f
 
+  def write(self, block):
+    if stopping.is_set(): raise KeyboardInterrupt
+    self.f.write(block)
+    sys.stdout.write('.')
+    sys.stdout.flush()
 
-def update_firmware(cat, version):
-  global args
 
-  print('Updating %s version %s' % (cat, version))
+def lookup_firmware(cat, version):
+  global args
 
   # Build XML request info
-  xml = ET.ElementTree(ET.fromstring(reqInfo))
+  xml = ET.ElementTree(copy.deepcopy(reqTemplate))
 
   # At least for MFC-J4510DW M1405200717:EFAC (see Internet dumps)
   # and MFC-J4625DW, and MFC-J4420DW
@@ -206,19 +246,18 @@ def update_firmware(cat, version):
   url += 'kne_bh7_update_nt_ssl/ifax2.asmx/fileUpdate'
   hdrs = {'Content-Type': 'text/xml'}
 
-  print('Looking up printer firmware info at vendor server...')
-  sys.stdout.flush()
-
   req = urllib.request.Request(url, requestInfo, hdrs)
-  response = urllib.request.urlopen(req)
+  response = urllib.request.urlopen(req, timeout = 60)
   response = response.read()
 
-  print('done')
-
   if args.verbose: print('response: %s' % response)
 
   # Parse response
-  xml = ET.fromstring(response)
+  return ET.fromstring(response)
+
+
+def check_firmware(cat, version, xml):
+  print('Checking %s version %s' % (cat, version))
 
   # Check version
   versionCheck = xml.find('FIRMUPDATEINFO/VERSIONCHECK')
@@ -232,68 +271,181 @@ def update_firmware(cat, version):
     print('No firmware update info path found')
     return
 
-  firmwareURL = firmwareURL.text
-  filename = firmwareURL.split('/')[-1]
+  return firmwareURL.text
 
-  # Download firmware
-  f = open(filename, 'wb')
 
-  print('Downloading firmware file %s from vendor server...' % filename)
-  sys.stdout.flush()
+def download_firmware(firmwareURL):
+  filename = firmwareURL.split('/')[-1]
+
+  infoFile = filename + '.info'
 
   req = urllib.request.Request(firmwareURL)
-  response = urllib.request.urlopen(req)
 
-  while True:
-    block = response.read(102400)
-    if not block: break
-    f.write(block)
-    sys.stdout.write('.')
-    sys.stdout.flush()
+  # A file from an earlier download is only reused if it is complete and the
+  # server confirms it has not changed since
+  try:
+    with open(infoFile) as f: cached = json.load(f)
+    if os.path.getsize(filename) != cached['size']: cached = None
+  except (OSError, ValueError, KeyError, TypeError): cached = None
 
-  print('done')
-  f.close()
+  if cached is not None:
+    if cached.get('etag'): req.add_header('If-None-Match', cached['etag'])
+    if cached.get('modified'):
+      req.add_header('If-Modified-Since', cached['modified'])
+
+  try:
+    response = urllib.request.urlopen(req, timeout = 60)
+  except urllib.error.HTTPError as e:
+    e.close()
+    if e.code == 304 and cached is not None: return filename
+    raise
+
+  if os.path.exists(infoFile): os.remove(infoFile)
+
+  # Download to a temporary name so an interrupted download is never reused
+  try:
+    with response, open(filename + '.part', 'wb') as f:
+      shutil.copyfileobj(response, ProgressWriter(f), 1 << 20)
+      size = f.tell()
+
+    # A connection closed early looks like the end of the file
+    length = response.headers.get('Content-Length')
+    if length is not None and size != int(length):
+      raise urllib.error.ContentTooShortError(
+        'Download of %s incomplete, got %d of %s bytes' % (
+          filename, size, length), None)
 
-  if args.test: return
+  except BaseException:
+    if os.path.exists(filename + '.part'): os.remove(filename + '.part')
+    raise
 
-  print('About to upload the firmware to printer.')
+  os.replace(filename + '.part', filename)
+
+  # Remember how the server identifies this version of the file
+  etag = response.headers.get('ETag')
+  modified = response.headers.get('Last-Modified')
+
+  if etag or modified:
+    cached = {'etag': etag, 'modified': modified, 'size': size}
+    with open(infoFile, 'w') as f: json.dump(cached, f)
+
+  return filename
+
+
+def upload_firmware(cat, version, filename):
+  global args
+
+  print('About to upload %s firmware (replacing version %s) from file %s to '
+        'printer.' % (cat, version, filename))
   print('This is a dangerous action since it is potentially destructive.')
   print('Thus please double-check / review to ensure that:')
   print('- firmware file version is compatible with your hardware')
   print('- network connection is reliable (prefer wired connection to WLAN)')
   print('- power is reliable')
-  input('Press Ctrl-C to prevent upgrade or Enter to continue...')
+  if not args.yes:
+    prompt('Press Ctrl-C to prevent upgrade or Enter to continue...')
 
   # Upload firmware to printer
   print('Now uploading firmware to printer (DO NOT REMOVE POWER!)...')
   sys.stdout.flush()
 
   if args.password is None:
-    ai = socket.getaddrinfo(args.ip, 9100, proto=socket.SOL_TCP)[0]
+    ai = socket.getaddrinfo(ip, 9100, proto = socket.SOL_TCP,
+                            flags = socket.AI_NUMERICHOST)[0]
     try:
       with socket.socket(ai[0], ai[1], ai[2]) as sock:
         sock.connect(ai[4])
-        sock.sendfile(open(filename, 'rb'))
 
-    except OSError as e:
+        # Only send full segments while streaming the file (Linux only)
+        cork = hasattr(socket, 'TCP_CORK')
+        if cork: sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+
+        with open(filename, 'rb', buffering = 0) as f:
+          if hasattr(os, 'sendfile'):
+            sock.sendfile(f, 0, os.path.getsize(filename))
+
+          else: # No zero-copy send, hand the kernel the whole mapped file
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+              sock.sendall(mm)
+
+        if cork: sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+
+    except (OSError, ValueError) as e: # mmap() rejects an empty file
       print('Firmware update aborted due to error while uploading')
       print(e)
   else:
     try:
-      ftp = FTP(args.ip, user = args.password) # Yes send password as user
-      ftp.storbinary('STOR ' + filename, open(filename, 'rb'))
+      ftp = FTP(ip, user = args.password) # Yes send password as user
+      with open(filename, 'rb') as f:
+        ftp.storbinary('STOR ' + filename, f, 1 << 20)
       ftp.quit()
     except ConnectionRefusedError as e:
       print('Firmware update aborted due to connection refused')
 
   print('done')
   print()
-  print('Wait for printer to finish updating and reboot before continuing.')
-  input('Press Enter to continue...')
 
-for entry in firmInfo:
+  if args.yes:
+    print('Waiting %d seconds for printer to finish updating and reboot...' %
+          args.reboot_wait)
+    sys.stdout.flush()
+    time.sleep(args.reboot_wait)
+    print('done')
+
+  else:
+    print('Wait for printer to finish updating and reboot before continuing.')
+    prompt('Press Enter to continue...')
+
+# Look up all firmwares at the vendor server concurrently
+print('Looking up printer firmware info at vendor server...')
+sys.stdout.flush()
+
+with ThreadPoolExecutor(max_workers = max(len(firmInfo), 1)) as executor:
+  responses = list(executor.map(
+    lambda entry: lookup_firmware(entry['cat'], entry['version']), firmInfo))
+
+print('done')
+
+# Find the firmwares which need updating, keyed by file name so that a file
+# shared by several categories is only downloaded and uploaded once
+updates = {}
+
+for entry, response in zip(firmInfo, responses):
   print()
-  update_firmware(entry['cat'], entry['version'])
+  firmwareURL = check_firmware(entry['cat'], entry['version'], response)
+  if firmwareURL is None: continue
+
+  filename = firmwareURL.split('/')[-1]
+  if filename in updates:
+    print('Same firmware file %s as category %s' % (
+      filename, updates[filename]['cat']))
+    continue
+
+  updates[filename] = dict(entry, url = firmwareURL)
+
+# Download all firmwares concurrently
+if updates:
+  print()
+  print('Downloading firmware files from vendor server...')
+  for filename in updates: print('  ' + filename)
+  sys.stdout.flush()
+
+  with ThreadPoolExecutor(max_workers = len(updates)) as executor:
+    try:
+      filenames = list(executor.map(
+        lambda update: download_firmware(update['url']), updates.values()))
+
+    except KeyboardInterrupt:
+      stopping.set() # Otherwise leaving the pool waits for every download
+      raise
+
+  print('done')
+
+  # Upload one at a time, the printer can only take one firmware at a time
+  if not args.test:
+    for update, filename in zip(updates.values(), filenames):
+      print()
+      upload_firmware(update['cat'], update['version'], filename)
 
 print()
 print('Success')